@@ -0,0 +1,353 @@
+import asyncio
+import queue
+import re
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email import base64mime
+from email.mime.text import MIMEText
+from email.policy import compat32
+from email.utils import formataddr, formatdate, make_msgid
+
+try:
+    import aiosmtplib
+    AIOSMTP_OK = True
+except Exception:
+    AIOSMTP_OK = False
+
+class _PipeliningMixin:
+    # RFC 2920: MAIL/RCPT/DATA in one write, replies read together, when EHLO offers PIPELINING
+    def _fail(self, code):
+        if code == 421: self.close()
+        else: self._rset()
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn("pipelining") or mail_options or rcpt_options or isinstance(to_addrs, str):
+            return super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+        if isinstance(msg, str): msg = re.sub(r"\r\n|\n|\r", "\r\n", msg).encode("ascii")
+        size = " SIZE=%d" % len(msg) if self.has_extn("size") else ""
+        cmds = ["mail FROM:%s%s" % (smtplib.quoteaddr(from_addr), size)]
+        cmds += ["rcpt TO:%s" % smtplib.quoteaddr(a) for a in to_addrs]
+        cmds.append("data")
+        self.send("".join(c + "\r\n" for c in cmds))
+        mcode, mresp = self.getreply()
+        rcpt = [self.getreply() for _ in to_addrs]
+        dcode, dresp = self.getreply()
+        refused = {a: r for a, r in zip(to_addrs, rcpt) if r[0] not in (250, 251)}
+        if dcode == 354 and (mcode != 250 or len(refused) == len(to_addrs)):
+            self.send(b".\r\n"); self.getreply()  # empty body, nothing was accepted anyway
+        if mcode != 250:
+            self._fail(mcode); raise smtplib.SMTPSenderRefused(mcode, mresp, from_addr)
+        if len(refused) == len(to_addrs):
+            self._fail(dcode); raise smtplib.SMTPRecipientsRefused(refused)
+        if dcode != 354:
+            self._fail(dcode); raise smtplib.SMTPDataError(dcode, dresp)
+        q = re.sub(rb"(?m)^\.", b"..", msg)
+        if q[-2:] != b"\r\n": q += b"\r\n"
+        self.send(q + b".\r\n")
+        code, resp = self.getreply()
+        if code != 250:
+            self._fail(code); raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+class PipeliningSMTP(_PipeliningMixin, smtplib.SMTP): pass
+class PipeliningSMTP_SSL(_PipeliningMixin, smtplib.SMTP_SSL): pass
+
+def open_smtp(host, port, use_ssl, user, pwd):
+    if use_ssl:
+        server = PipeliningSMTP_SSL(host, int(port))
+    else:
+        server = PipeliningSMTP(host, int(port))
+        try: server.starttls()
+        except Exception: pass
+    try:
+        if user: server.login(user, pwd)
+    except Exception:
+        close_smtp(server); raise
+    return server
+
+def close_smtp(server):
+    try: server.quit()
+    except Exception: pass
+
+class SmtpSessionError(OSError):
+    # could not connect or log in; retrying per message only hammers the account into a lockout
+    pass
+
+class SmtpPool:
+    # logged-in sessions shared by the send threads, recycled every messages_per_connection
+    def __init__(self, size, host, port, use_ssl, user, pwd, messages_per_connection=100):
+        self.size = size
+        self.messages_per_connection = messages_per_connection
+        self._args = (host, port, use_ssl, user, pwd)
+        self._idle = queue.Queue()
+        for _ in range(size): self._idle.put(None)  # opened lazily on first use
+
+    def _fresh(self, slot):
+        if slot is not None and slot[1] < self.messages_per_connection: return slot
+        if slot is not None: close_smtp(slot[0])
+        try: return [open_smtp(*self._args), 0]
+        except Exception as e: raise SmtpSessionError(e) from e
+
+    def send(self, from_addr, to_addrs, data):
+        slot = self._idle.get()
+        try:
+            slot = self._fresh(slot)
+            try:
+                refused = slot[0].sendmail(from_addr, to_addrs, data)
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError):
+                close_smtp(slot[0]); slot = None
+                slot = self._fresh(None)
+                refused = slot[0].sendmail(from_addr, to_addrs, data)
+            slot[1] += 1
+            return refused
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError):
+            raise  # per-message failure, the session itself is still usable
+        except Exception:
+            if slot is not None: close_smtp(slot[0]); slot = None
+            raise
+        finally:
+            self._idle.put(slot)
+
+    def close(self):
+        for _ in range(self.size):
+            slot = self._idle.get()
+            if slot is not None: close_smtp(slot[0])
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
+SMTP_POOL_SIZE = 2  # default session count; Office 365 allows only a few concurrent SMTP AUTH connections per mailbox
+
+class CircuitBreaker:
+    # opens after `threshold` failures (None: never); shared by the send threads
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._open = threading.Event()
+
+    @property
+    def is_open(self): return self._open.is_set()
+
+    def record_failure(self, n=1):
+        with self._lock:
+            self.failures += n
+            if self.threshold is not None and self.failures >= self.threshold: self._open.set()
+
+    def trip(self): self._open.set()
+
+RATE_LIMIT_CODES = (421, 450, 451)  # transient codes that also halve the send rate
+TOO_MANY_RCPTS = 452  # over the server's per-transaction limit: send the rest in a new transaction
+
+class TokenBucket:
+    # reserve() books a slot and returns the wait, so async callers can await it
+    def __init__(self, rate, burst=1, restore_after=50, min_rate=1.0):
+        self.base_rate = self.rate = float(rate)
+        self.min_rate = min(min_rate, self.base_rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.restore_after = restore_after
+        self._streak = 0
+        self._slowed_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0: time.sleep(wait)
+
+    def slow_down(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._slowed_at < 1.0 / self.rate: return  # several threads hit the same throttle; halve once
+            self._slowed_at = now
+            self.rate = max(self.rate * 0.5, self.min_rate)
+            self._streak = 0
+
+    def record_success(self):
+        # climb back towards the configured rate after a run of clean sends
+        with self._lock:
+            self._streak += 1
+            if self._streak >= self.restore_after and self.rate < self.base_rate:
+                self.rate = min(self.base_rate, self.rate * 2)
+                self._streak = 0
+
+def breaker_threshold(total):
+    # small batches always run to the end; big ones stop once a third (at least 10) have failed
+    return max(10, total // 3) if total >= 30 else None
+
+RCPT_CHUNK = 50
+
+def group_jobs(keys, tos, subjects, bodies, tpl):
+    # (keys, recipients, data), keys passed through per recipient (e.g. row positions);
+    # identical subject+body share a transaction of up to RCPT_CHUNK
+    groups = {}
+    for key, to, sub, body in zip(keys, tos, subjects, bodies):
+        groups.setdefault((sub, body), []).append((key, to))
+    jobs = []
+    for (sub, body), members in groups.items():
+        if len(members) == 1:
+            (key, to), = members
+            jobs.append(((key,), (to,), tpl.render(to, sub, body)))
+            continue
+        for i in range(0, len(members), RCPT_CHUNK):
+            chunk = members[i:i + RCPT_CHUNK]
+            # shared copies must not list the other candidates' addresses
+            jobs.append((tuple(c for c, _ in chunk), tuple(t for _, t in chunk), tpl.render("undisclosed-recipients:;", sub, body)))
+    return jobs
+
+def _refusal_codes(tos, refused, exc):
+    # {recipient: SMTP code} for whatever this attempt refused, whichever library raised it
+    if exc is None: return {a: r[0] for a, r in refused.items()}
+    if isinstance(exc, smtplib.SMTPRecipientsRefused): return {a: r[0] for a, r in exc.recipients.items()}
+    if AIOSMTP_OK and isinstance(exc, aiosmtplib.SMTPRecipientsRefused): return {r.recipient: r.code for r in exc.recipients}
+    if isinstance(exc, smtplib.SMTPResponseException): return dict.fromkeys(tos, exc.smtp_code)
+    if AIOSMTP_OK and isinstance(exc, aiosmtplib.SMTPResponseException): return dict.fromkeys(tos, exc.code)
+    return dict.fromkeys(tos)
+
+def _job_plan(job, bucket, breaker):
+    # retry/back-off/breaker rules for one job, shared by both senders: yields the recipients to
+    # send to, is sent back (refused, exc) for each attempt, returns {recipient: reason} failures
+    failed, tos, retried = {}, job[1], False
+    while True:
+        refused, exc = yield tos
+        if exc is None: failed.update((a, str({a: r})) for a, r in refused.items())
+        else: failed.update(dict.fromkeys(tos, str(exc)))
+        if isinstance(exc, SmtpSessionError):
+            breaker.trip()  # bad login or unreachable server: stop before the next job logs in again
+            break
+        codes = _refusal_codes(tos, refused, exc)
+        transient = tuple(a for a in tos if a in failed and 400 <= (codes.get(a) or 0) < 500)
+        if not transient: break
+        # 452 after some recipients got through is progress, keep going; any other 4xx is retried once
+        if not (len(transient) < len(tos) and all(codes[a] == TOO_MANY_RCPTS for a in transient)):
+            if retried: break
+            retried = True
+        if any(codes[a] in RATE_LIMIT_CODES for a in transient):
+            bucket.slow_down()  # server is throttling us: halve the rate before retrying
+        for a in transient: del failed[a]
+        tos = transient
+    if failed: breaker.record_failure(len(failed))
+    if len(failed) < len(job[1]): bucket.record_success()
+    return failed
+
+def send_all_threaded(jobs, from_addr, smtp_args, size, bucket, breaker):
+    # {recipient: reason} failures per job, None where the breaker skipped it
+    def _send_job(job):
+        if breaker.is_open: return None
+        plan = _job_plan(job, bucket, breaker)
+        tos = next(plan)
+        while True:
+            bucket.acquire()
+            try: outcome = pool.send(from_addr, list(tos), job[2]), None
+            except OSError as e: outcome = None, e  # every smtplib error is an OSError
+            try: tos = plan.send(outcome)
+            except StopIteration as done: return done.value
+
+    with SmtpPool(size, *smtp_args) as pool, ThreadPoolExecutor(max_workers=size) as ex:
+        return list(ex.map(_send_job, jobs))
+
+async def _open_async_smtp(host, port, use_ssl, user, pwd):
+    smtp = aiosmtplib.SMTP(hostname=host, port=int(port), use_tls=use_ssl)
+    try: await smtp.connect()
+    except Exception as e: raise SmtpSessionError(e) from e
+    try:
+        if user: await smtp.login(user, pwd)
+    except Exception as e:
+        await _close_async_smtp(smtp)
+        raise SmtpSessionError(e) from e
+    return smtp
+
+async def _close_async_smtp(smtp):
+    try: await smtp.quit()
+    except Exception: pass
+
+async def send_all_async(jobs, from_addr, smtp_args, size, bucket, breaker, messages_per_connection=100):
+    # opt-in aiosmtplib sender with the same contract; `size` workers, one session each, drain a shared queue
+    results = [None] * len(jobs)
+    todo = asyncio.Queue()
+    for i in range(len(jobs)): todo.put_nowait(i)
+
+    async def _worker():
+        smtp, used = None, 0
+
+        async def _send(tos, data):
+            nonlocal smtp, used
+            try:
+                if smtp is not None and used >= messages_per_connection:
+                    await _close_async_smtp(smtp); smtp = None
+                if smtp is None: smtp, used = await _open_async_smtp(*smtp_args), 0
+                try:
+                    errors, _ = await smtp.sendmail(from_addr, list(tos), data)
+                except aiosmtplib.SMTPServerDisconnected:
+                    smtp = None
+                    smtp, used = await _open_async_smtp(*smtp_args), 0
+                    errors, _ = await smtp.sendmail(from_addr, list(tos), data)
+                used += 1
+                return errors, None
+            except (aiosmtplib.SMTPRecipientsRefused, aiosmtplib.SMTPResponseException) as e:
+                return None, e  # per-message refusal, the session is still usable
+            except (aiosmtplib.SMTPException, OSError) as e:
+                if smtp is not None: await _close_async_smtp(smtp); smtp = None
+                return None, e
+
+        try:
+            while not todo.empty():
+                i = todo.get_nowait()
+                if breaker.is_open: continue
+                plan = _job_plan(jobs[i], bucket, breaker)
+                tos = next(plan)
+                while True:
+                    await asyncio.sleep(bucket.reserve())
+                    outcome = await _send(tos, jobs[i][2])
+                    try: tos = plan.send(outcome)
+                    except StopIteration as done:
+                        results[i] = done.value
+                        break
+        finally:
+            if smtp is not None: await _close_async_smtp(smtp)
+
+    await asyncio.gather(*(_worker() for _ in range(max(1, min(size, len(jobs))))))
+    return results
+
+def build_mime(fname, femail, to_email, sub, body_text):
+    msg = MIMEText(body_text, _charset="utf-8")
+    msg["Subject"] = sub
+    msg["From"] = formataddr((fname, femail))
+    msg["To"] = to_email
+    msg["Date"] = formatdate(localtime=True)
+    msg["Message-Id"] = make_msgid()
+    return msg
+
+SMTP_POLICY = compat32.clone(linesep="\r\n")
+
+class MimeTemplate:
+    # build_mime layout as CRLF bytes; the shared headers are generated once per subject
+    def __init__(self, fname, femail):
+        self.from_header = formataddr((fname, femail))
+        self._heads = {}
+
+    def _head(self, sub):
+        head = self._heads.get(sub)
+        if head is None:
+            msg = MIMEText("", _charset="utf-8")
+            msg["Subject"] = sub
+            msg["From"] = self.from_header
+            head = self._heads[sub] = msg.as_string(policy=SMTP_POLICY).encode("ascii").split(b"\r\n\r\n", 1)[0] + b"\r\n"
+        return head
+
+    def render(self, to_email, sub, body_text):
+        # to_email has passed EMAIL_RE, so it is short plain ASCII and needs no folding or encoding
+        tail = f"To: {to_email}\r\nDate: {formatdate(localtime=True)}\r\nMessage-Id: {make_msgid()}\r\n\r\n"
+        return self._head(sub) + tail.encode("ascii") + base64mime.body_encode(body_text.encode("utf-8"), eol="\r\n").encode("ascii")
@@ -5,19 +5,22 @@ import pandas as pd
 import numpy as np
 import joblib
 from sklearn.base import BaseEstimator, TransformerMixin
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer, TfidfTransformer
 from sklearn.linear_model import LogisticRegression
 from sklearn.compose import ColumnTransformer
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import FunctionTransformer
 import re
-import smtplib
-from email.mime.text import MIMEText
-from email.utils import formataddr, formatdate, make_msgid
 import textwrap
 from tempfile import NamedTemporaryFile
 import os
-import time
+import io
+import hashlib
+import asyncio
+from functools import lru_cache
+from dataclasses import dataclass
+from mailer import (AIOSMTP_OK, SMTP_POOL_SIZE, CircuitBreaker, MimeTemplate, TokenBucket, breaker_threshold,
+                    build_mime, close_smtp, group_jobs, open_smtp, send_all_async, send_all_threaded)
 
 try:
     import fitz
@@ -25,6 +28,36 @@ try:
 except Exception:
     PDF_OK = False
 
+try:
+    from pythainlp import word_tokenize
+    THAI_OK = True
+except Exception:
+    THAI_OK = False
+
+try:
+    from nlpo3 import load_dict, segment
+    from pythainlp.corpus import corpus_path
+
+    @st.cache_resource(show_spinner=False)
+    def _load_nlpo3_dict():
+        # nlpo3 keeps dictionaries for the whole process, so load once and let reruns reuse the result
+        return load_dict(os.path.join(corpus_path(), "words_th.txt"), "default")[1]
+
+    NLPO3_OK = _load_nlpo3_dict()
+except Exception:
+    NLPO3_OK = False
+
+try:
+    import ahocorasick
+    AC_OK = True
+except Exception:
+    AC_OK = False
+
+try:
+    import re2 as union_re
+except Exception:
+    union_re = re
+
 HR_USERS = {
     "hr01": "1234",
     "admin": "admin123"
@@ -69,31 +102,52 @@ if "pass_cut" not in st.session_state:
     st.session_state["pass_cut"] = 0.5
 
 # ---------- helpers ----------
+@lru_cache(maxsize=4096)
+def _norm_cached(text):
+    return " ".join(text.lower().split())
+
 def normalize_text(text):
     if not isinstance(text, str): return ""
-    text = text.lower()
-    text = re.sub(r"\s+", " ", text).strip()
-    return text
+    return _norm_cached(text)
 
-def thai_tokenize(text):
-    text = normalize_text(text)
-    if not text: return []
+def _segment(text):
+    if not text: return ()
     try:
-        from pythainlp import word_tokenize
-        return [t for t in word_tokenize(text, keep_whitespace=False) if t.strip()]
+        if NLPO3_OK:
+            return tuple(t for t in segment(text, "default") if t.strip())
+        if THAI_OK:
+            return tuple(t for t in word_tokenize(text, keep_whitespace=False) if t.strip())
+        return tuple(text.split())
     except Exception:
-        return text.split()
+        return tuple(text.split())
+
+@st.cache_resource(show_spinner=False)
+def _token_cache():
+    # every rerun executes this script in a fresh __main__; the memo lives here so it outlasts reruns
+    return lru_cache(maxsize=8192)(_segment)
+
+_tok_cached = _token_cache()
+
+def thai_tokenize(text):
+    # cache on the normalized string; TfidfVectorizer expects a fresh list
+    return list(_tok_cached(normalize_text(text)))
+
+EDU_MAPPING = {normalize_text(k): v for k, v in {
+    "มัธยม":0,"ม.6":0,"ปวช":0,"hs":0,"high school":0,
+    "ปวส":1,"อนุปริญญา":1,"bachelor":1,"ปริญญาตรี":1,"ba":1,"b.sc":1,"b.eng":1,
+    "master":2,"ปริญญาโท":2,"m.sc":2,"mba":2,
+    "phd":3,"doctorate":3,"ปริญญาเอก":3
+}.items()}
 
 def encode_education(level):
     if not isinstance(level, str): return 0
     s = normalize_text(level)
-    mapping = {
-        "มัธยม":0,"ม.6":0,"ปวช":0,"hs":0,"high school":0,
-        "ปวส":1,"อนุปริญญา":1,"bachelor":1,"ปริญญาตรี":1,"ba":1,"b.sc":1,"b.eng":1,
-        "master":2,"ปริญญาโท":2,"m.sc":2,"mba":2,
-        "phd":3,"doctorate":3,"ปริญญาเอก":3
-    }
-    return mapping.get(s, mapping.get(s.title(), 0))
+    return EDU_MAPPING.get(s, EDU_MAPPING.get(s.title(), 0))
+
+def encode_education_series(s):
+    # same lookup as encode_education, one pass over the column (no key is numeric, so non-strings still map to 0)
+    s = s.fillna("").astype(str).str.lower().str.split().str.join(" ")
+    return s.map(EDU_MAPPING).fillna(0)
 
 def split_skills(skills):
     if not isinstance(skills, str): return []
@@ -102,20 +156,23 @@ def split_skills(skills):
 def concat_text_df(df, fields):
     cols = [c for c in fields if c in df.columns]
     if not cols: return pd.Series([""] * len(df))
-    return df[cols].apply(lambda r: " ".join((str(r[c]).lower() if isinstance(r[c], str) else str(r[c])) for c in cols), axis=1)
+    parts = [df[c].fillna("").astype(str).str.lower() for c in cols]
+    return parts[0].str.cat(parts[1:], sep=" ", na_rep="")
 
 def extract_text_from_pdf(uploaded_file):
     if not PDF_OK: return ""
     try:
         uploaded_file.seek(0)
-        text = ""
+        parts = []
+        # whitespace is collapsed by normalize_text later, so let MuPDF skip preserving it
+        flags = fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_PRESERVE_WHITESPACE
         with fitz.open(stream=uploaded_file.read(), filetype="pdf") as doc:
             if doc.is_encrypted:
                 try: doc.authenticate("")
                 except Exception: pass
             for page in doc:
-                text += page.get_text("text")
-        return text.strip()
+                parts.append(page.get_text("text", flags=flags))
+        return "".join(parts).strip()
     except Exception as e:
         st.warning(f"อ่าน PDF ไม่สำเร็จ: {e}")
         return ""
@@ -123,23 +180,47 @@ def extract_text_from_pdf(uploaded_file):
 class EducationEncoder(BaseEstimator, TransformerMixin):
     def fit(self, X, y=None): return self
     def transform(self, X):
-        return X["education_level"].apply(encode_education).astype(float).values.reshape(-1, 1)
+        return encode_education_series(X["education_level"]).to_numpy(dtype=np.float32).reshape(-1, 1)
+
+def _col_float32(col):
+    try: v = col.astype(np.float32, copy=False)
+    except (TypeError, ValueError): v = pd.to_numeric(pd.Series(col), errors="coerce").to_numpy(dtype=np.float32)
+    return np.nan_to_num(v, nan=0.0)
 
 def combine_exp_func(arr):
     if hasattr(arr, "__dataframe__") or isinstance(arr, pd.DataFrame):
-        y = pd.to_numeric(arr.get("years_experience", 0), errors="coerce").fillna(0)
-        m = pd.to_numeric(arr.get("months_experience", 0), errors="coerce").fillna(0)
-        return (y + m/12.0).values.reshape(-1,1)
+        y = pd.to_numeric(arr.get("years_experience", 0), errors="coerce").to_numpy(dtype=np.float32, na_value=0.0)
+        m = pd.to_numeric(arr.get("months_experience", 0), errors="coerce").to_numpy(dtype=np.float32, na_value=0.0)
+        return (y + m/12.0).reshape(-1,1)
     a = np.asarray(arr)
-    y = pd.to_numeric(pd.Series(a[:,0]), errors="coerce").fillna(0)
-    m = pd.to_numeric(pd.Series(a[:,1] if a.shape[1]>1 else 0), errors="coerce").fillna(0)
-    return np.asarray(y+m/12.0).reshape(-1,1)
+    y = _col_float32(a[:,0])
+    m = _col_float32(a[:,1]) if a.shape[1]>1 else 0.0
+    return (y + m/12.0).reshape(-1,1)
+
+def to_float32(arr):
+    return np.asarray(arr, dtype=np.float32).reshape(len(arr), -1)
 
 def safe_load_joblib(p):
-    try: return joblib.load(p)
+    try: return joblib.load(p, mmap_mode="r")
     except Exception: return None
 
-def atomic_joblib_dump(obj, path, compress=3):
+# one deserialization per file version, shared across reruns; only the latest is kept
+@st.cache_resource(show_spinner=False, max_entries=1)
+def _load_model(path, mtime):
+    return safe_load_joblib(path)
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def _load_uploaded_model(digest, _data):
+    return joblib.load(io.BytesIO(_data))
+
+# the on-disk model is uncompressed for fast loads; downloads still get zlib
+@st.cache_data(show_spinner=False, max_entries=1)
+def _export_model_bytes(path, mtime, compress=3):
+    buf = io.BytesIO()
+    joblib.dump(joblib.load(path), buf, compress=compress)
+    return buf.getvalue()
+
+def atomic_joblib_dump(obj, path, compress=0):
     os.makedirs(os.path.dirname(path), exist_ok=True)
     with NamedTemporaryFile(delete=False, dir=os.path.dirname(path), suffix=".tmp") as t:
         tmp = t.name
@@ -152,22 +233,70 @@ def atomic_joblib_dump(obj, path, compress=3):
             except Exception: pass
 
 # email clean/validate
-WS_EDGES = re.compile(r'^\s+|\s+$', flags=re.UNICODE)
 INVISIBLE = {"\u200b", "\ufeff"}
 WIDE_SPACES = {"\u00a0", "\u202f", "\u2007", "\u2009", "\u200a", "\u205f", "\u3000"}
 EMAIL_RE = re.compile(r"^[A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,}$")
 BLOCKED_DEMO_DOMAINS = {"example.com","test.com","invalid","example.org","example.net"}
+INVIS_TRANSLATE = str.maketrans({**{ch: "" for ch in INVISIBLE}, **{ch: " " for ch in WIDE_SPACES}})
 
 def clean_email(s):
-    if not isinstance(s, str): return ""
-    for ch in INVISIBLE: s = s.replace(ch, "")
-    for ch in WIDE_SPACES: s = s.replace(ch, " ")
-    return WS_EDGES.sub("", s)
+    return s.translate(INVIS_TRANSLATE).strip() if isinstance(s, str) else ""
+
+def clean_email_series(s):
+    return s.fillna("").astype(str).str.translate(INVIS_TRANSLATE).str.strip()
+
+def valid_email_mask(s):
+    s = clean_email_series(s)
+    return s.str.match(EMAIL_RE) & ~s.str.split("@").str[-1].str.lower().isin(BLOCKED_DEMO_DOMAINS)
+
+@st.cache_data(show_spinner=False)
+def cached_valid_email_mask(emails):
+    return valid_email_mask(emails)
+
+# email templates
+def _render_template_series(tpl, ctx, index):
+    # {{key}} filling where each ctx value may be a Series aligned on index; unknown keys stay as written
+    out = pd.Series("", index=index, dtype=object)
+    for part in re.split(r"(\{\{\w+\}\})", tpl):
+        key = part[2:-2] if part.startswith("{{") and part.endswith("}}") else None
+        if key in ctx:
+            v = ctx[key]
+            out = out + (v if isinstance(v, pd.Series) else str(v))
+        elif part:
+            out = out + part
+    return out
+
+@dataclass(frozen=True, slots=True)
+class MsgCtx:
+    # everything the result emails need besides the row; frozen so it can key st.cache_data
+    subj_pass: str
+    subj_fail: str
+    tpl_pass: str
+    tpl_fail: str
+    max_reasons: int
+    department: str
+    name_col: str = "name"
+
+def render_messages(frame, ctx):
+    index = frame.index
+    name = _col(frame, ctx.name_col, "ผู้สมัคร").map(str).str.strip()
+    fields = {
+        "name": name.mask(name.eq(""), "ผู้สมัคร"),
+        "candidate_id": _col(frame, "candidate_id", "").map(str),
+        "department": ctx.department,
+        "score": _col(frame, "final_priority", 0).map("{:.2f}".format),
+        "reasons": _col(frame, "reasons", "").map(str).str.split("; ").str[:ctx.max_reasons].str.join("; ")
+    }
+    passed = _col(frame, "predicted_level", None).eq("ผ่าน")
+    subjects = _render_template_series(ctx.subj_pass, fields, index).where(passed, _render_template_series(ctx.subj_fail, fields, index))
+    bodies = _render_template_series(ctx.tpl_pass, fields, index).where(passed, _render_template_series(ctx.tpl_fail, fields, index))
+    return subjects, bodies
 
-def is_valid_email(s):
-    s = clean_email(s)
-    if not s or not EMAIL_RE.match(s): return False
-    return s.split("@")[-1].lower() not in BLOCKED_DEMO_DOMAINS
+@st.cache_data(show_spinner=False)
+def _build_previews(df_head, email_col, ctx):
+    subjects, bodies = render_messages(df_head, ctx)
+    addrs = _col(df_head, email_col, "")
+    return [f"To: {a}\nSubject: {s}\n\n{b}" for a, s, b in zip(addrs, subjects, bodies)]
 
 # ---------- configs ----------
 DEPARTMENTS_CFG = {
@@ -277,6 +406,9 @@ with st.sidebar:
         smtp_pass = st.text_input("Password/App Password", type="password")
         from_name = st.text_input("From Name", value="HR Team")
         from_email = st.text_input("From Email (ควรตรงกับ Username)", value=smtp_user)
+        max_per_second = st.number_input("ส่งสูงสุดต่อวินาที", min_value=1, max_value=1000, value=10)
+        pool_size = st.number_input("จำนวนการเชื่อมต่อ SMTP พร้อมกัน", min_value=1, max_value=10, value=SMTP_POOL_SIZE)
+        use_async = AIOSMTP_OK and st.toggle("ส่งแบบ asyncio (aiosmtplib)", value=False)
 
         subj_pass = "[บริษัท] ผลการสมัครงาน – ผ่านการคัดกรอง"
         subj_fail = "[บริษัท] ผลการสมัครงาน – ไม่ผ่านการคัดกรอง"
@@ -299,26 +431,14 @@ with st.sidebar:
         st.markdown("---")
 
         def _send_email(h, p, ssl_on, user, pwd, fname, femail, to_email, sub, body_text):
-            msg = MIMEText(body_text, _charset="utf-8")
-            msg["Subject"] = sub
-            msg["From"] = formataddr((fname, femail))
-            msg["To"] = to_email
-            msg["Date"] = formatdate(localtime=True)
-            msg["Message-Id"] = make_msgid()
-            if ssl_on:
-                server = smtplib.SMTP_SSL(h, int(p))
-            else:
-                server = smtplib.SMTP(h, int(p))
-                try: server.starttls()
-                except Exception: pass
+            msg = build_mime(fname, femail, to_email, sub, body_text)
+            server = open_smtp(h, p, ssl_on, user, pwd)
             try:
-                if user: server.login(user, pwd)
                 refused = server.sendmail(femail, [to_email], msg.as_string())
                 ok = (len(refused) == 0)
                 return ok, ("" if ok else str(refused))
             finally:
-                try: server.quit()
-                except Exception: pass
+                close_smtp(server)
 
         test_to = st.text_input("ทดสอบส่งไปที่อีเมล", value=smtp_user or "")
         if st.button("ทดสอบส่งเมล"):
@@ -329,136 +449,248 @@ with st.sidebar:
             else: st.error(f"ส่งทดสอบไม่สำเร็จ: refused {info}")
 
 # ---------- ML ----------
-def build_pipeline(text_fields):
-    text_vect = TfidfVectorizer(tokenizer=thai_tokenize, token_pattern=None, ngram_range=(1,2), min_df=1, max_df=0.95)
-    text_transformer = Pipeline(steps=[
-        ("concat", FunctionTransformer(concat_text_df, kw_args={"fields": tuple(text_fields)}, validate=False)),
-        ("tfidf", text_vect)
-    ])
+HASHING_MIN_ROWS = 20000
+
+def build_pipeline(text_fields, hashing=False):
+    concat = ("concat", FunctionTransformer(concat_text_df, kw_args={"fields": tuple(text_fields)}, validate=False))
+    if hashing:
+        # large training sets: no vocabulary pass, fixed memory regardless of corpus size
+        text_transformer = Pipeline(steps=[
+            concat,
+            ("hash", HashingVectorizer(tokenizer=thai_tokenize, token_pattern=None, ngram_range=(1,2), n_features=2**18, alternate_sign=False, norm=None, dtype=np.float32)),
+            ("tfidf", TfidfTransformer())
+        ])
+    else:
+        text_vect = TfidfVectorizer(tokenizer=thai_tokenize, token_pattern=None, ngram_range=(1,2), min_df=1, max_df=0.95, dtype=np.float32)
+        text_transformer = Pipeline(steps=[concat, ("tfidf", text_vect)])
     pre = ColumnTransformer(
         transformers=[
             ("text", text_transformer, text_fields),
             ("exp", FunctionTransformer(combine_exp_func, validate=False), ["years_experience","months_experience"]),
             ("edu", EducationEncoder(), ["education_level"]),
-            ("age", "passthrough", ["age"])
+            ("age", FunctionTransformer(to_float32, validate=False), ["age"])
         ],
         remainder="drop"
     )
-    clf = LogisticRegression(max_iter=300)
+    clf = LogisticRegression(solver="liblinear", max_iter=300)
     return Pipeline(steps=[("pre", pre), ("clf", clf)])
 
-def _apply_global_knockout(blob, cfg):
+def _col(df, col, default):
+    if col in df.columns: return df[col]
+    return pd.Series([default] * len(df), index=df.index)
+
+def _num_col(df, col, default):
+    return pd.to_numeric(_col(df, col, default), errors="coerce").fillna(default).to_numpy(dtype=float)
+
+def _norm_col(df, col):
+    return _col(df, col, "").map(str).map(normalize_text)
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def _automaton(phrases):
+    A = ahocorasick.Automaton()
+    for j, p in enumerate(phrases): A.add_word(p, (j, len(p)))
+    A.make_automaton()
+    return A
+
+@lru_cache(maxsize=64)
+def _union_pattern(phrases):
+    return union_re.compile("|".join(union_re.escape(p) for p in phrases))
+
+def _find_phrases(texts, phrases):
+    # first position of every phrase in every text (-1 = absent), one scan per text
+    phrases = tuple(phrases)
+    uniq = tuple(dict.fromkeys(p for p in phrases if p))
+    upos = np.full((len(texts), len(uniq)), -1, dtype=np.int64)
+    if uniq and AC_OK:
+        A = _automaton(uniq)
+        for i, t in enumerate(texts.tolist()):
+            for end, (j, L) in A.iter(t):
+                if upos[i, j] < 0: upos[i, j] = end - L + 1
+    elif uniq:
+        # one union scan rules out texts with no phrase at all; only the rest pay per-phrase finds
+        pat = _union_pattern(uniq)
+        cand = np.flatnonzero([pat.search(t) is not None for t in texts.tolist()])
+        sub = texts.iloc[cand]
+        for j, p in enumerate(uniq):
+            upos[cand, j] = sub.str.find(p).to_numpy()
+    col = {p: j for j, p in enumerate(uniq)}
+    pos = np.zeros((len(texts), len(phrases)), dtype=np.int64)
+    for j, p in enumerate(phrases):
+        if p: pos[:, j] = upos[:, col[p]]
+    return pos
+
+def prepare_rules(cfg):
+    # normalize every config phrase once per screening run; rule_score_batch reads cfg["_prepared"]
     gk = cfg.get("global_knockout", DEFAULT_RULES["global_knockout"])
+    mitig = cfg.get("global_mitigation", DEFAULT_RULES["global_mitigation"])
+    indicators = cfg.get("training_indicators", DEFAULT_RULES["training_indicators"])
+    aw = cfg.get("activity_weights", DEFAULT_RULES.get("activity_weights", {}))
+    levels = [(level, normalize_text(phrase)) for level in ["hard","soft","review"] for phrase in gk.get(level, [])]
+    must = tuple(cfg.get("must_have_skills", []))
+    nice = tuple(cfg.get("nice_to_have_skills", []))
+    prep = {
+        "gk_levels": tuple((level, p) for level, p in levels if p),
+        "whitelist": tuple(normalize_text(x) for x in mitig.get("whitelist_phrases", [])),
+        "mitigate_terms": tuple(normalize_text(x) for x in mitig.get("mitigate_terms", [])),
+        "knockout": tuple((phrase, normalize_text(phrase)) for phrase in cfg.get("knockout_phrases", [])),
+        "training_indicators": tuple(normalize_text(x) for x in indicators),
+        "training_patterns": _training_patterns(tuple(indicators), must),
+        "activities": tuple((k, normalize_text(k), wt) for k, wt in aw.items()),
+        "must": must, "must_set": frozenset(must),
+        "nice": nice, "nice_set": frozenset(nice),
+    }
+    return {**cfg, "_prepared": prep}
+
+def _prepared(cfg):
+    return cfg["_prepared"] if "_prepared" in cfg else prepare_rules(cfg)["_prepared"]
+
+def _apply_global_knockout(blobs, cfg):
+    prep = _prepared(cfg)
     weights = cfg.get("global_knockout_weights", DEFAULT_RULES["global_knockout_weights"])
     cap = cfg.get("global_knockout_cap", DEFAULT_RULES["global_knockout_cap"])
     mitig = cfg.get("global_mitigation", DEFAULT_RULES["global_mitigation"])
-    wlist = [normalize_text(x) for x in mitig.get("whitelist_phrases", [])]
-    mterms = [normalize_text(x) for x in mitig.get("mitigate_terms", [])]
+    wlist, mterms, levels = prep["whitelist"], prep["mitigate_terms"], prep["gk_levels"]
     factor = float(mitig.get("mitigation_factor", 0.5))
     ctx = int(mitig.get("context_window", 50))
-    penalty = 0.0
-    hits = []
-    for level in ["hard","soft","review"]:
-        for phrase in gk.get(level, []):
-            p = normalize_text(phrase)
-            if not p: continue
-            pos = blob.find(p)
-            if pos == -1: continue
-            if any(normalize_text(w) in blob for w in wlist):
-                hits.append(f"{p}~whitelist"); continue
-            start = max(0, pos - ctx); end = min(len(blob), pos + len(p) + ctx)
-            window = blob[start:end]
+    n = len(blobs)
+    penalty = np.zeros(n)
+    hits = [[] for _ in range(n)]
+    texts = blobs.tolist()
+    pos_all = _find_phrases(blobs, (*wlist, *(p for _, p in levels)))
+    whitelisted = (pos_all[:, :len(wlist)] >= 0).any(axis=1)
+    capped = np.zeros(n, dtype=bool)
+    for j, (level, p) in enumerate(levels):
+        found = pos_all[:, len(wlist) + j]
+        # rows already clamped at the cap cannot change any further
+        for i in np.flatnonzero((found >= 0) & ~capped):
+            if whitelisted[i]:
+                hits[i].append(f"{p}~whitelist"); continue
+            pos = found[i]; blob = texts[i]
+            window = blob[max(0, pos - ctx):pos + len(p) + ctx]
             weight = float(weights.get(level, 0.0))
             if any(t in window for t in mterms) and weight < 0:
-                weight *= factor; hits.append(f"{p}:{level}*{factor:.1f}")
+                weight *= factor; hits[i].append(f"{p}:{level}*{factor:.1f}")
             else:
-                hits.append(f"{p}:{level}")
-            penalty += weight
-    if penalty < cap: penalty = cap
-    return penalty, hits
-
-def rule_score(row, cfg):
-    def _to_num(x):
-        try: return float(x)
-        except: return 0.0
-    w = cfg.get("rule_weights", DEFAULT_RULES["rule_weights"])
-    reasons, score = [], 0.0
-
-    y = _to_num(row.get("years_experience", 0))
-    m = _to_num(row.get("months_experience", 0))
-    total = y + m/12.0
-    if total < cfg["min_years_experience"]:
-        reasons.append(f"ประสบการณ์ {total:.1f} ปี < {cfg['min_years_experience']} ปี"); score += w.get("exp_under", -1.0)
-    else:
-        reasons.append(f"ประสบการณ์ {total:.1f} ปี ≥ เกณฑ์"); score += w.get("exp_meet", 0.2)
-
-    if encode_education(row.get("education_level","")) < encode_education(cfg["min_education_level"]):
-        reasons.append(f"การศึกษา < {cfg['min_education_level']}"); score += w.get("edu_under", -1.0)
-
-    skills = set(split_skills(row.get("skills","")))
-    miss = [s for s in cfg["must_have_skills"] if s not in skills]
-    if miss:
-        reasons.append("ขาดสกิลจำเป็น: "+", ".join(miss)); score += w.get("must_missing", -1.5)
-    else:
-        reasons.append("ครบสกิลจำเป็น"); score += w.get("must_all", 0.5)
-
-    blob = " ".join([normalize_text(str(row.get(f,""))) for f in cfg["text_fields"]])
-
-    gk_pen, gk_hits = _apply_global_knockout(blob, cfg)
-    if gk_hits: reasons.append("คำต้องห้ามรวม: " + ", ".join(gk_hits))
-    score += gk_pen
-
-    for phrase in cfg.get("knockout_phrases", []):
-        if normalize_text(phrase) in blob:
-            reasons.append(f"คำต้องห้ามตำแหน่ง: {phrase}"); score += w.get("knockout", -2.0)
-
-    training_indicators = cfg.get("training_indicators", DEFAULT_RULES["training_indicators"])
-    ind_alt = "(" + "|".join(map(re.escape, training_indicators)) + ")"
-    for s in cfg.get("must_have_skills", []):
+                hits[i].append(f"{p}:{level}")
+            penalty[i] += weight
+            if penalty[i] <= cap: capped[i] = True
+    return np.maximum(penalty, cap), hits
+
+@lru_cache(maxsize=64)
+def _training_patterns(indicators, skills):
+    # one pattern per skill: indicator before or after it, compiled once per config
+    ind_alt = "(?:" + "|".join(map(re.escape, indicators)) + ")"
+    pats = []
+    for s in skills:
         s_esc = re.escape(s)
-        ps1 = re.compile(ind_alt + r".{0,40}\b" + s_esc + r"\b")
-        ps2 = re.compile(r"\b" + s_esc + r"\b.{0,40}" + ind_alt)
-        if ps1.search(blob) or ps2.search(blob):
-            reasons.append(f"{s}: พบในบริบทการอบรม/คอร์ส"); score += w.get("training_ctx", -0.5)
+        pats.append((s, re.compile(ind_alt + r".{0,40}\b" + s_esc + r"\b|\b" + s_esc + r"\b.{0,40}" + ind_alt)))
+    return tuple(pats)
+
+# static department rules, merged and prepared once at import
+RULES_BY_DEPT = {d: prepare_rules({**DEFAULT_RULES, **c, **DEFAULT_BASE}) for d, c in DEPARTMENTS_CFG.items()}
 
-    nice = [s for s in cfg.get("nice_to_have_skills", []) if s in skills]
-    if nice:
-        reasons.append("มีสกิลเสริม: "+", ".join(nice)); score += w.get("nice_each", 0.3) * len(nice)
+def rule_score_batch(df, cfg):
+    prep = _prepared(cfg)
+    cfg = {**cfg, "_prepared": prep}
+    w = cfg.get("rule_weights", DEFAULT_RULES["rule_weights"])
+    n = len(df)
+    scores = np.zeros(n)
+    reasons = [[] for _ in range(n)]
+
+    total = _num_col(df, "years_experience", 0) + _num_col(df, "months_experience", 0)/12.0
+    min_exp = cfg["min_years_experience"]
+    under = total < min_exp
+    scores += np.where(under, w.get("exp_under", -1.0), w.get("exp_meet", 0.2))
+    for i in range(n):
+        if under[i]: reasons[i].append(f"ประสบการณ์ {total[i]:.1f} ปี < {min_exp} ปี")
+        else: reasons[i].append(f"ประสบการณ์ {total[i]:.1f} ปี ≥ เกณฑ์")
+
+    edu = encode_education_series(_col(df, "education_level", "")).to_numpy()
+    edu_under = edu < encode_education(cfg["min_education_level"])
+    scores += np.where(edu_under, w.get("edu_under", -1.0), 0.0)
+    for i in np.flatnonzero(edu_under):
+        reasons[i].append(f"การศึกษา < {cfg['min_education_level']}")
+
+    must, must_set = prep["must"], prep["must_set"]
+    skill_sets = [set(split_skills(x)) for x in _col(df, "skills", "")]
+    for i, skills in enumerate(skill_sets):
+        miss = [] if must_set <= skills else [s for s in must if s not in skills]
+        if miss:
+            reasons[i].append("ขาดสกิลจำเป็น: "+", ".join(miss)); scores[i] += w.get("must_missing", -1.5)
+        else:
+            reasons[i].append("ครบสกิลจำเป็น"); scores[i] += w.get("must_all", 0.5)
+
+    fields = cfg["text_fields"]
+    parts = [_norm_col(df, f) for f in fields]
+    blobs = parts[0].str.cat(parts[1:], sep=" ") if parts else pd.Series([""] * n, index=df.index)
+    texts = blobs.tolist()
+
+    gk_pen, gk_hits = _apply_global_knockout(blobs, cfg)
+    for i, h in enumerate(gk_hits):
+        if h: reasons[i].append("คำต้องห้ามรวม: " + ", ".join(h))
+    scores += gk_pen
+
+    knockout = prep["knockout"]
+    ko_pos = _find_phrases(blobs, [p for _, p in knockout])
+    for j, (phrase, _) in enumerate(knockout):
+        mask = ko_pos[:, j] >= 0
+        scores += np.where(mask, w.get("knockout", -2.0), 0.0)
+        for i in np.flatnonzero(mask):
+            reasons[i].append(f"คำต้องห้ามตำแหน่ง: {phrase}")
+
+    for s, pat in prep["training_patterns"]:
+        mask = np.fromiter((pat.search(b) is not None for b in texts), dtype=bool, count=n)
+        scores += np.where(mask, w.get("training_ctx", -0.5), 0.0)
+        for i in np.flatnonzero(mask):
+            reasons[i].append(f"{s}: พบในบริบทการอบรม/คอร์ส")
+
+    nice_all, nice_set = prep["nice"], prep["nice_set"]
+    for i, skills in enumerate(skill_sets):
+        if nice_set.isdisjoint(skills): continue
+        nice = [s for s in nice_all if s in skills]
+        if nice:
+            reasons[i].append("มีสกิลเสริม: "+", ".join(nice)); scores[i] += w.get("nice_each", 0.3) * len(nice)
 
     low_exp = max(0.5, cfg.get("min_years_experience",0)/2)
-    for s in cfg.get("must_have_skills", []):
-        if s in skills and total < low_exp:
-            reasons.append(f"มี {s} แต่ประสบการณ์รวม < {low_exp:.1f} ปี"); score += w.get("low_exp_skill", -0.3)
+    for i in np.flatnonzero(total < low_exp):
+        for s in must:
+            if s in skill_sets[i]:
+                reasons[i].append(f"มี {s} แต่ประสบการณ์รวม < {low_exp:.1f} ปี"); scores[i] += w.get("low_exp_skill", -0.3)
 
-    age_val = _to_num(row.get("age", -1))
+    age_val = _num_col(df, "age", -1)
     age_range = cfg.get("age_range", DEFAULT_RULES.get("default_age_range", [18,60]))
-    if age_val >= 0:
-        if not (age_range[0] <= age_val <= age_range[1]):
-            reasons.append(f"อายุ {int(age_val)} ปี อยู่นอกช่วง ({age_range[0]}–{age_range[1]})"); score += w.get("age_out", -1.0)
-        else:
-            reasons.append(f"อายุ {int(age_val)} ปี อยู่ในช่วงที่กำหนด"); score += w.get("age_in", 0.2)
-    else:
-        reasons.append("ไม่ระบุอายุ (ไม่คิดคะแนน)")
-
-    acts = normalize_text(str(row.get("activities", "")))
-    aw = cfg.get("activity_weights", DEFAULT_RULES.get("activity_weights", {}))
+    known = age_val >= 0
+    in_range = (age_range[0] <= age_val) & (age_val <= age_range[1])
+    scores += np.where(known, np.where(in_range, w.get("age_in", 0.2), w.get("age_out", -1.0)), 0.0)
+    for i in range(n):
+        if not known[i]: reasons[i].append("ไม่ระบุอายุ (ไม่คิดคะแนน)")
+        elif in_range[i]: reasons[i].append(f"อายุ {int(age_val[i])} ปี อยู่ในช่วงที่กำหนด")
+        else: reasons[i].append(f"อายุ {int(age_val[i])} ปี อยู่นอกช่วง ({age_range[0]}–{age_range[1]})")
+
+    acts = _norm_col(df, "activities")
     max_bonus = cfg.get("max_activity_bonus", DEFAULT_RULES.get("max_activity_bonus", 0.0))
-    is_training_like_activity = any(normalize_text(ind) in acts for ind in training_indicators)
-    bonus = 0.0; hits=[]
-    for k, wt in aw.items():
-        if normalize_text(k) in acts:
-            hits.append(f"{k}+{wt}"); bonus += float(wt)
-    if bonus > 0:
-        if is_training_like_activity:
-            reasons.append("กิจกรรมมีลักษณะอบรม: ไม่ได้โบนัสกิจกรรม")
+    indicators, activities = prep["training_indicators"], prep["activities"]
+    act_pos = _find_phrases(acts, (*indicators, *(nk for _, nk, _ in activities)))
+    training_like = (act_pos[:, :len(indicators)] >= 0).any(axis=1)
+    bonus = np.zeros(n)
+    act_hits = [[] for _ in range(n)]
+    for j, (k, _, wt) in enumerate(activities):
+        mask = act_pos[:, len(indicators) + j] >= 0
+        bonus[mask] += float(wt)
+        for i in np.flatnonzero(mask):
+            act_hits[i].append(f"{k}+{wt}")
+    for i in np.flatnonzero(bonus > 0):
+        if training_like[i]:
+            reasons[i].append("กิจกรรมมีลักษณะอบรม: ไม่ได้โบนัสกิจกรรม")
         else:
-            bonus = min(bonus, max_bonus)
-            reasons.append("กิจกรรม: " + ", ".join(hits) + (f" (รวม +{bonus:.1f})" if bonus>0 else "")); score += bonus
+            b = min(bonus[i], max_bonus)
+            reasons[i].append("กิจกรรม: " + ", ".join(act_hits[i]) + (f" (รวม +{b:.1f})" if b>0 else "")); scores[i] += b
 
-    return score, reasons
+    return scores, reasons
 
-def bucket_level(final_priority, pass_cut):
-    return "ผ่าน" if final_priority >= pass_cut else "ไม่ผ่าน"
+def blend_and_bucket(proba, rscores, pass_cut):
+    final = 0.7 * np.asarray(proba, dtype=float) + 0.3 * (1 / (1 + np.exp(-np.asarray(rscores, dtype=float))))
+    return final, np.where(final >= pass_cut, "ผ่าน", "ไม่ผ่าน")
 
 # ---------- tabs ----------
 tab_train, tab_screen = st.tabs(["ฝึกสอนโมเดล (CSV)", "คัดกรองใบสมัคร (CSV/PDF)"])
@@ -470,7 +702,8 @@ with tab_train:
     with c2:
         train_btn = st.button("เริ่มฝึกสอน", type="primary", use_container_width=True)
         if (MODEL_DIR / "model.joblib").exists():
-            st.download_button("ดาวน์โหลดโมเดล", data=open(MODEL_DIR / "model.joblib","rb"),
+            model_path = MODEL_DIR / "model.joblib"
+            st.download_button("ดาวน์โหลดโมเดล", data=_export_model_bytes(str(model_path), model_path.stat().st_mtime),
                                file_name="model.joblib", use_container_width=True)
     if train_btn and train_file is not None:
         df = pd.read_csv(train_file)
@@ -483,10 +716,11 @@ with tab_train:
             st.error(f"คอลัมน์หายไป: {miss}")
         else:
             y = df["label"]
-            pipe = build_pipeline(["resume_text","cover_letter_text","skills","activities"])
+            pipe = build_pipeline(["resume_text","cover_letter_text","skills","activities"], hashing=len(df) >= HASHING_MIN_ROWS)
             with st.spinner("กำลังฝึกสอน..."):
                 pipe.fit(df, y)
-                atomic_joblib_dump({"pipeline": pipe, "config": DEFAULT_BASE}, MODEL_DIR / "model.joblib", compress=3)
+                _load_model.clear()  # drop the old mmap before replacing the file (Windows won't replace a mapped file)
+                atomic_joblib_dump({"pipeline": pipe, "config": DEFAULT_BASE}, MODEL_DIR / "model.joblib")
             st.success("ฝึกสอนสำเร็จ")
 
 with tab_screen:
@@ -501,11 +735,12 @@ with tab_screen:
         model = None
         if up_model is not None:
             try:
-                model = joblib.load(up_model); st.success("โหลดโมเดลจากไฟล์อัปโหลดสำเร็จ")
+                data = up_model.getvalue()
+                model = _load_uploaded_model(hashlib.sha256(data).hexdigest(), data); st.success("โหลดโมเดลจากไฟล์อัปโหลดสำเร็จ")
             except Exception as e:
                 st.error(f"โหลดโมเดลจากไฟล์ไม่สำเร็จ: {e}")
         if model is None and (MODEL_DIR / "model.joblib").exists():
-            model = safe_load_joblib(MODEL_DIR / "model.joblib")
+            model = _load_model(str(MODEL_DIR / "model.joblib"), (MODEL_DIR / "model.joblib").stat().st_mtime)
             if model is None:
                 st.error("ไฟล์โมเดลล่าสุดเสีย โปรดฝึกใหม่หรืออัปโหลดไฟล์ใหม่")
         if model is None and not (MODEL_DIR / "model.joblib").exists():
@@ -513,12 +748,6 @@ with tab_screen:
     with c3:
         run_btn = st.button("เริ่มประเมิน", type="primary", use_container_width=True)
 
-    def _render_template(tpl, ctx):
-        out = tpl
-        for k, v in ctx.items():
-            out = out.replace(f"{{{{{k}}}}}", str(v))
-        return out
-
     if run_btn and infile is not None and model is not None:
         pipe = model["pipeline"]
         if ftype.endswith("PDF"):
@@ -542,25 +771,25 @@ with tab_screen:
             st.error(f"คอลัมน์หายไป: {miss}")
         else:
             proba = pipe.predict_proba(df)[:, 1]
+            merged_cfg = RULES_BY_DEPT[department]
+            rscores, reasons_all = rule_score_batch(df, merged_cfg)
+            finals, levels = blend_and_bucket(proba, rscores, pass_cut)
             rows = []
-            for i, row in df.iterrows():
-                # ←← แก้เรียบร้อย: ปิดด้วย '}' ไม่ใช่ ']'
-                merged_cfg = {**DEFAULT_RULES, **DEPARTMENTS_CFG[department], **DEFAULT_BASE}
-                rscore, reasons = rule_score(row, merged_cfg)
-                final = 0.7 * float(proba[i]) + 0.3 * (1 / (1 + np.exp(-rscore)))
+            for i, row in enumerate(df.to_dict("records")):
+                rscore, reasons = rscores[i], reasons_all[i]
+                final, level = finals[i], str(levels[i])
 
                 def _to_num(x):
                     try: return float(x)
                     except: return 0.0
 
-                level = bucket_level(final, pass_cut)
                 y_exp = _to_num(row.get("years_experience", 0)); m_exp = _to_num(row.get("months_experience", 0))
                 total_months = int(round(y_exp * 12 + m_exp))
                 y_show = total_months // 12; m_show = total_months % 12
                 rows.append({
                     "candidate_id": row.get("candidate_id", i),
                     "name": row.get("name","ผู้สมัคร"),
-                    "email": clean_email(row.get("email","")),
+                    "email": row.get("email",""),
                     "experience_text": f"{int(y_show)} ปี {int(m_show)} เดือน",
                     "age": (int(row.get("age", -1)) if pd.notna(row.get("age", -1)) else -1),
                     "predicted_fit": round(float(proba[i]), 4),
@@ -570,7 +799,7 @@ with tab_screen:
                     "reasons": "; ".join(reasons)
                 })
             out = pd.DataFrame(rows).sort_values("final_priority", ascending=False).reset_index(drop=True)
-            out["email"] = out["email"].apply(clean_email)
+            out["email"] = clean_email_series(out["email"])  # cleaned once; the email section reads it as-is
 
             m1, m2, m3 = st.columns(3)
             m1.markdown(f'<div class="kpi"><h4>จำนวนผู้สมัคร</h4><div class="v">{len(out)}</div></div>', unsafe_allow_html=True)
@@ -586,7 +815,9 @@ with tab_screen:
             if chosen_cols: out = out[chosen_cols]
 
             st.dataframe(out, use_container_width=True, hide_index=True)
-            st.download_button("ดาวน์โหลดผล (CSV)", data=out.to_csv(index=False).encode("utf-8"),
+            csv_buf = io.BytesIO()
+            out.to_csv(csv_buf, index=False, encoding="utf-8")
+            st.download_button("ดาวน์โหลดผล (CSV)", data=csv_buf.getvalue(),
                                file_name="screened_pass_fail.csv", use_container_width=True)
 
             st.subheader("แจ้งผลผู้สมัครทางอีเมล")
@@ -595,37 +826,25 @@ with tab_screen:
                 max_reasons = st.slider("จำกัดจำนวนเหตุผลที่แสดง (เฉพาะกรณีไม่ผ่าน)", 1, 10, 3)
                 preview_n = st.number_input("ดูตัวอย่างกี่รายการ", min_value=1, max_value=max(1, len(out)), value=min(3, len(out)))
 
-                def _mk_message(rowx):
-                    ctx = {
-                        "name": str(rowx.get(name_col, "ผู้สมัคร")).strip() or "ผู้สมัคร",
-                        "candidate_id": rowx.get("candidate_id",""),
-                        "department": department,
-                        "score": f"{rowx.get('final_priority',0):.2f}",
-                        "reasons": "; ".join(str(rowx.get("reasons","")).split("; ")[:max_reasons])
-                    }
-                    passed = (rowx.get("predicted_level") == "ผ่าน")
-                    subject = subj_pass if passed else subj_fail
-                    body_tpl = msg_tpl_pass if passed else msg_tpl_fail
-                    return _render_template(subject, ctx), _render_template(body_tpl, ctx)
+                msg_ctx = MsgCtx(subj_pass, subj_fail, msg_tpl_pass, msg_tpl_fail, int(max_reasons), department, name_col)
 
+                # reruns with the same head/templates hit the cache; the full table is only rendered when sending
                 st.markdown("ตัวอย่างอีเมล")
-                for i in range(int(preview_n)):
-                    r = out.iloc[i]
-                    addr = clean_email(r.get(email_col, ""))
-                    subj, body = _mk_message(r)
-                    st.code(f"To: {addr}\nSubject: {subj}\n\n{body}")
-
-                out["email_valid"] = out[email_col].apply(is_valid_email)
-                bad_rows = out[~out["email_valid"]]
-                if len(bad_rows) > 0:
-                    st.error(f"พบอีเมลไม่พร้อมส่ง {len(bad_rows)} รายการ (โดเมนตัวอย่าง/รูปแบบผิด/ว่าง) — จะถูกข้าม")
-                    st.dataframe(bad_rows[["candidate_id","name","email"]], use_container_width=True, hide_index=True)
-
-                test_idx = st.selectbox("ทดสอบส่งเฉพาะราย (ลำดับในตาราง):", list(range(len(out))) or [0])
+                for text in _build_previews(out.head(int(preview_n)).reset_index(drop=True), email_col, msg_ctx):
+                    st.code(text)
+
+                out["email_valid"] = cached_valid_email_mask(out[email_col])
+                n_bad = int((~out["email_valid"]).sum())
+                if n_bad > 0:
+                    st.error(f"พบอีเมลไม่พร้อมส่ง {n_bad} รายการ (โดเมนตัวอย่าง/รูปแบบผิด/ว่าง) — จะถูกข้าม")
+                    with st.expander("ดูรายการอีเมลที่จะถูกข้าม", expanded=False):
+                        st.dataframe(out.loc[~out["email_valid"], ["candidate_id","name","email"]], use_container_width=True, hide_index=True)
+
+                test_idx = st.number_input("ทดสอบส่งเฉพาะราย (ลำดับในตาราง):", min_value=0, max_value=max(0, len(out) - 1), value=0, step=1)
                 if st.button("ส่งทดสอบเฉพาะรายนี้"):
                     r = out.iloc[int(test_idx)]
-                    to_email = clean_email(r.get(email_col, ""))
-                    subj, body = _mk_message(r)
+                    to_email = r.get(email_col, "")
+                    subj, body = (x.iloc[0] for x in render_messages(out.iloc[[int(test_idx)]], msg_ctx))
                     ok, info = _send_email(st.session_state.get("smtp_host", smtp_host), st.session_state.get("smtp_port", smtp_port),
                                            st.session_state.get("use_ssl", use_ssl), smtp_user, smtp_pass,
                                            from_name, from_email or smtp_user, to_email, subj, body)
@@ -634,26 +853,37 @@ with tab_screen:
 
                 do_send = st.button("ส่งอีเมลแจ้งผลทั้งหมด", type="primary")
                 if do_send:
-                    sent, failed, skipped = 0, 0, 0
-                    logs = []
-                    for _, r in out.iterrows():
-                        to_email = clean_email(r.get(email_col, ""))
-                        if not is_valid_email(to_email):
-                            skipped += 1
-                            logs.append({"candidate_id": r["candidate_id"], "to": to_email, "status": "SKIPPED", "reason": "invalid/demo domain"})
-                            continue
-                        subj, body = _mk_message(r)
-                        ok, info = _send_email(smtp_host, smtp_port, use_ssl, smtp_user, smtp_pass,
-                                               from_name, from_email or smtp_user, to_email, subj, body)
-                        if ok:
-                            sent += 1
-                            logs.append({"candidate_id": r["candidate_id"], "to": to_email, "status": "SENT", "reason": ""})
-                        else:
-                            failed += 1
-                            logs.append({"candidate_id": r["candidate_id"], "to": to_email, "status": "FAILED", "reason": f"refused: {info}"})
-                        time.sleep(1.0)
+                    femail = from_email or smtp_user
+                    mask = out["email_valid"].to_numpy(dtype=bool)
+                    sub = out[["candidate_id", email_col]].rename(columns={email_col: "email"})
+                    sub["mail_subject"], sub["mail_body"] = render_messages(out, msg_ctx)
+
+                    # log columns follow the ranked table; jobs carry row positions so results land back in place
+                    n = len(sub)
+                    status, reason = np.full(n, "SKIPPED", dtype="U8"), np.full(n, "invalid/demo domain", dtype=object)
+                    sendable = sub[mask]
+                    jobs = group_jobs(np.flatnonzero(mask), sendable["email"], sendable["mail_subject"], sendable["mail_body"],
+                                      MimeTemplate(from_name, femail))
+
+                    breaker = CircuitBreaker(breaker_threshold(len(out)))
+                    bucket = TokenBucket(max_per_second)
+                    smtp_args = (smtp_host, smtp_port, use_ssl, smtp_user, smtp_pass)
+                    if use_async:
+                        results = asyncio.run(send_all_async(jobs, femail, smtp_args, int(pool_size), bucket, breaker))
+                    else:
+                        results = send_all_threaded(jobs, femail, smtp_args, int(pool_size), bucket, breaker)
+                    for (rows, tos, _), failed in zip(jobs, results):
+                        for j, to_email in zip(rows, tos):
+                            if failed is None: status[j], reason[j] = "SKIPPED", "circuit_open"
+                            elif to_email in failed: status[j], reason[j] = "FAILED", f"refused: {failed[to_email]}"
+                            else: status[j], reason[j] = "SENT", ""
+                    sent, failed = int((status == "SENT").sum()), int((status == "FAILED").sum())
+                    skipped = n - sent - failed
                     st.success(f"ส่งอีเมลสำเร็จ {sent} รายการ, ล้มเหลว {failed} รายการ, ข้าม {skipped} รายการ")
-                    st.dataframe(pd.DataFrame(logs), use_container_width=True, hide_index=True)
+                    if breaker.is_open:
+                        st.warning(f"หยุดส่งก่อนครบ (aborted early: too many failures) — ล้มเหลวแล้ว {breaker.failures} รายการ")
+                    log_df = pd.DataFrame({"candidate_id": sub["candidate_id"].to_numpy(), "to": sub["email"].to_numpy(), "status": pd.Categorical(status), "reason": reason}, copy=False)
+                    st.dataframe(log_df, use_container_width=True, hide_index=True)
             else:
                 st.info("เปิดสวิตช์ 'เปิดใช้งานแจ้งผลผู้สมัครทางอีเมล' ในแถบด้านซ้ายเพื่อใช้งานฟังก์ชันนี้")
 